@@ -1,17 +1,28 @@
-# Import required libraries for PySpark operations, mathematical calculations, 
-# and datetime handling
+# Import required libraries for PySpark operations and datetime handling
+# Note: the column functions (sin, cos, asin, sqrt, radians, ...) come from
+# pyspark.sql.functions, so they build Spark expressions rather than
+# evaluating Python floats
+import os
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import *
-from pyspark.sql.window import Window
 from pyspark.sql.types import *
-from math import radians, cos, sin, asin, sqrt
 from datetime import datetime, timedelta
 
 # Initialize Spark Session with all available cores
 # This creates a local session that can utilize all CPU cores
+# Adaptive query execution coalesces the small post-aggregation shuffles
+# (a few hundred users) and shuffle partitions are sized to the cores
+# instead of the default 200
 spark = SparkSession.builder \
     .appName("GPS_Trajectory_Analysis") \
     .master("local[*]") \
+    .config("spark.sql.session.timeZone", "UTC") \
+    .config("spark.sql.adaptive.enabled", "true") \
+    .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+    .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+    .config("spark.sql.shuffle.partitions", str(os.cpu_count() * 2)) \
+    .config("spark.sql.autoBroadcastJoinThreshold", "32MB") \
     .getOrCreate()
     
 #Run 'spark-submit gps_analysis.py' in the terminal to execute this script.
@@ -35,58 +46,130 @@ schema = StructType([
     StructField("Time", StringType(), True)
 ])
 
-# Read the GPS trajectory data from CSV file using the defined schema
-df = spark.read.csv("dataset.txt", header=True, schema=schema)
+# Spatial grid used to partition the Parquet copy of the data
+# Each record is assigned to a grid_deg x grid_deg cell, encoded as
+# lat_index * 1000 + lon_index, so range queries such as the Beijing filter
+# can skip whole partition directories
+grid_deg = 0.5
+
+def grid_index(degrees):
+    """
+    Return the grid row/column index of a latitude or longitude
+    given in decimal degrees
+    """
+    return int(degrees // grid_deg)
+
+# Convert the CSV data to Parquet once and read that on every run
+# The Parquet copy is partitioned by grid cell and sorted by user and
+# timestamp, so the CSV is only parsed the first time and row group min/max
+# statistics can prune scans for the range filters below
+parquet_path = "geolife.parquet"
+if not os.path.exists(parquet_path):
+    spark.read.csv("dataset.txt", header=True, schema=schema) \
+        .withColumn("grid_cell",
+            (floor(col("Latitude") / grid_deg) * 1000
+             + floor(col("Longitude") / grid_deg)).cast("int")) \
+        .repartition("grid_cell") \
+        .sortWithinPartitions("UserID", "Timestamp") \
+        .write.partitionBy("grid_cell") \
+        .parquet(parquet_path)
+
+# Read the GPS trajectory data from the Parquet copy
+# AllZero and the grid cell are never used, so they are pruned from the scan
+df = spark.read.parquet(parquet_path).drop("AllZero", "grid_cell")
 
 # Task 1: Time Zone Conversion
 # Convert timestamps from GMT to local time based on longitude
 # Process:
-# 1. Calculate timezone offset (15 degrees = 1 hour)
-# 2. Adjust timestamp by adding offset (converted to days)
-# 3. Convert adjusted timestamp to readable date and time
-# 4. Account for Excel epoch (25569 days offset)
+# 1. Calculate timezone offset (15 degrees = 1 hour, truncated to whole hours)
+# 2. Convert the Excel timestamp to epoch seconds and add the offset in a
+#    single expression, accounting for the Excel epoch (25569 days offset)
+# 3. Bucket the adjusted time into an integer day number (days since
+#    1970-01-01), used as the grouping key by the later tasks
+# 4. Convert to readable date and time only when displaying results
 df_adjusted = df \
-    .withColumn("timezone_offset", (col("Longitude") / 15).cast("int")) \
-    .withColumn("adjusted_timestamp", col("Timestamp") + (col("timezone_offset") / 24)) \
-    .withColumn("adjusted_date", from_unixtime((col("adjusted_timestamp") - 25569) * 86400, "yyyy-MM-dd")) \
-    .withColumn("adjusted_time", from_unixtime((col("adjusted_timestamp") - 25569) * 86400, "HH:mm:ss"))
+    .withColumn("adj_epoch_s",
+        col("Timestamp") * lit(86400.0)
+        + (col("Longitude") / 15).cast("int") * lit(3600)
+        - lit(25569.0 * 86400.0)) \
+    .withColumn("adj_day", floor(col("adj_epoch_s") / 86400).cast("int"))
 
-# Use the timezone-adjusted DataFrame for all subsequent operations
-df = df_adjusted
+# Display-time conversion of the adj_day bucket back to a calendar date
+adjusted_date = expr("date_add(DATE'1970-01-01', adj_day)").alias("adjusted_date")
 
 # Display sample of adjusted data to verify timezone conversion
 print("Sample of timezone adjusted data:")
-df.select("Longitude", "timezone_offset", "Timestamp", "adjusted_timestamp", "Date", "adjusted_date", "Time", "adjusted_time").show(5)
+df_adjusted.select(
+    "Longitude", "Timestamp", "adj_epoch_s", "Date", adjusted_date, "Time",
+    from_unixtime(col("adj_epoch_s"), "HH:mm:ss").alias("adjusted_time")
+).show(5)
+
+# Use the timezone-adjusted DataFrame for all subsequent operations
+# The raw Timestamp, Date and Time columns are only needed for the sample
+# above, so they are dropped before caching
+# Nearly every task groups or windows by UserID, so hash partition on it once
+# and cache the result; later aggregations reuse this partitioning instead of
+# re-reading dataset.txt and shuffling again
+df = df_adjusted \
+    .drop("Timestamp", "Date", "Time") \
+    .repartition(spark.sparkContext.defaultParallelism * 2, "UserID") \
+    .persist(StorageLevel.MEMORY_AND_DISK)
+df.count()  # Materialize the cache
 
 # Task 2: Beijing Records Filter
 # Filter records within Beijing's approximate borders:
 # - Latitude: 39.5° to 40.5° N
 # - Longitude: 115.5° to 117.5° E
 # This creates a rectangular boundary around Beijing
-beijing_df = df.filter(
-    (col("Latitude") >= 39.5) & 
-    (col("Latitude") <= 40.5) & 
-    (col("Longitude") >= 115.5) & 
-    (col("Longitude") <= 117.5)
-)
+# The grid cells overlapping the boundary are filtered first, which only
+# touches partition metadata, then the exact boundary is applied to the
+# surviving rows
+# The records are counted per user in the same job, so the small cached
+# result provides both the total record count and Task 5's visitor set
+beijing_cells = [
+    lat_index * 1000 + lon_index
+    for lat_index in range(grid_index(39.5), grid_index(40.5) + 1)
+    for lon_index in range(grid_index(115.5), grid_index(117.5) + 1)
+]
+beijing_df = spark.read.parquet(parquet_path) \
+    .filter(col("grid_cell").isin(beijing_cells)) \
+    .filter(
+        (col("Latitude") >= 39.5) & 
+        (col("Latitude") <= 40.5) & 
+        (col("Longitude") >= 115.5) & 
+        (col("Longitude") <= 117.5)
+    )
+
+beijing_users = beijing_df \
+    .groupBy("UserID") \
+    .agg(count("*").alias("beijing_records")) \
+    .cache()
 
 print("\nTask 2: Beijing Records")
-beijing_count = beijing_df.count()
+beijing_count = beijing_users.agg(sum("beijing_records")).first()[0]
 print(f"Number of records in Beijing area: {beijing_count}")
 
+# Daily Aggregation shared by Tasks 3, 4 and 6
+# Point counts and altitude extremes per user and day are computed in a
+# single pass and cached, instead of grouping the full dataset once per task
+daily = df.groupBy("UserID", "adj_day") \
+    .agg(
+        count("*").alias("daily_points"),
+        (max("Altitude") - min("Altitude")).alias("daily_span")
+    ) \
+    .persist()
+
 # Task 3: Days with >10 Points Analysis
 # Process:
-# 1. Group records by user and date
-# 2. Count points per day
-# 3. Filter for days with more than 10 points
-# 4. Count qualifying days per user
-# 5. Sort by count (descending) and UserID (ascending) for ties
-daily_points = df.groupBy("UserID", "adjusted_date") \
-    .agg(count("*").alias("daily_points")) \
+# 1. Take the per-day point counts from the daily aggregation
+# 2. Filter for days with more than 10 points
+# 3. Count qualifying days per user
+# 4. Sort by count (descending) and UserID (ascending) for ties
+daily_points = daily \
     .filter(col("daily_points") > 10) \
     .groupBy("UserID") \
     .agg(count("*").alias("days_with_points")) \
-    .orderBy(col("days_with_points").desc(), col("UserID").asc()) \
+    .orderBy(col("days_with_points").desc_nulls_last(), col("UserID").asc()) \
     .limit(6)
 
 print("\nTask 3: Users with >10 daily points")
@@ -94,19 +177,25 @@ daily_points.show()
 
 # Task 4: Weeks with >100 Points Analysis
 # Process:
-# 1. Extract ISO week number from adjusted date
-# 2. Group by user and week
-# 3. Count points per week
+# 1. Build a small adj_day -> ISO week lookup covering the data's date range
+# 2. Attach week numbers to the daily aggregation with a broadcast join
+# 3. Sum the daily point counts per user and week
 # 4. Filter for weeks with >100 points
 # 5. Count qualifying weeks per user
-weekly_points = df \
-    .withColumn("WeekOfYear", weekofyear(to_date(col("adjusted_date")))) \
+# 6. Sort by count (descending) and UserID (ascending) for ties
+first_day, last_day = daily.agg(min("adj_day"), max("adj_day")).first()
+week_lookup = spark.range(first_day, last_day + 1) \
+    .select(col("id").cast("int").alias("adj_day")) \
+    .withColumn("WeekOfYear", weekofyear(expr("date_add(DATE'1970-01-01', adj_day)")))
+
+weekly_points = daily \
+    .join(broadcast(week_lookup), "adj_day") \
     .groupBy("UserID", "WeekOfYear") \
-    .agg(count("*").alias("weekly_points")) \
+    .agg(sum("daily_points").alias("weekly_points")) \
     .filter(col("weekly_points") > 100) \
     .groupBy("UserID") \
     .agg(count("*").alias("weeks_with_points")) \
-    .orderBy(col("weeks_with_points").desc())
+    .orderBy(col("weeks_with_points").desc_nulls_last(), col("UserID").asc())
 
 print("\nTask 4: Users with >100 weekly points")
 weekly_points.show()
@@ -114,29 +203,28 @@ weekly_points.show()
 # Task 5: Northernmost Points Analysis
 # Process:
 # 1. Find highest latitude point for each user (with earliest date for ties)
+#    as the max of a (Latitude, -adj_day) struct, which structs compare
+#    field by field, so it reduces map-side without sorting
 # 2. Identify users who visited Beijing
 # 3. Join results to show Beijing visits for top 6 northernmost points
 northernmost = df \
-    .withColumn("rank", 
-        row_number().over(
-            Window.partitionBy("UserID")
-            .orderBy(col("Latitude").desc(), to_date(col("adjusted_date")).asc())
-        )) \
-    .filter(col("rank") == 1) \
-    .select("UserID", "Latitude", "adjusted_date") \
+    .groupBy("UserID") \
+    .agg(max(struct("Latitude", (-col("adj_day")).alias("neg_day"))).alias("top")) \
+    .select("UserID", col("top.Latitude").alias("Latitude"), (-col("top.neg_day")).alias("adj_day")) \
     .orderBy(col("Latitude").desc()) \
     .limit(6)
 
 # Get list of users who visited Beijing area
-beijing_visitors = beijing_df.select("UserID").distinct()
+# There are only a few hundred users, so the set is broadcast to the join
+beijing_visitors = broadcast(
+    beijing_users.select("UserID").withColumn("VisitedBeijing", lit("True"))
+)
 
 # Join northernmost points with Beijing visitors information
 northernmost_with_beijing = northernmost \
     .join(beijing_visitors, "UserID", "left_outer") \
-    .withColumn("VisitedBeijing", 
-        when(beijing_visitors.UserID.isNotNull(), "True")
-        .otherwise("False")) \
-    .select("UserID", "Latitude", "adjusted_date", "VisitedBeijing") \
+    .withColumn("VisitedBeijing", coalesce(col("VisitedBeijing"), lit("False"))) \
+    .select("UserID", "Latitude", adjusted_date, "VisitedBeijing") \
     .orderBy(col("Latitude").desc())
 
 print("\nTask 5: Northernmost points and Beijing visits")
@@ -144,15 +232,13 @@ northernmost_with_beijing.show()
 
 # Task 6: Altitude Span Calculation
 # Process:
-# 1. Calculate daily altitude range (max - min) for each user
+# 1. Take the daily altitude range (max - min) from the daily aggregation
 # 2. Find maximum range across all days for each user
 # 3. Select top 6 users by maximum range
-altitude_span = df \
-    .groupBy("UserID", "adjusted_date") \
-    .agg((max("Altitude") - min("Altitude")).alias("daily_span")) \
+altitude_span = daily \
     .groupBy("UserID") \
     .agg(max("daily_span").alias("max_span")) \
-    .orderBy(col("max_span").desc(), col("UserID").asc()) \
+    .orderBy(col("max_span").desc_nulls_last(), col("UserID").asc()) \
     .limit(6)
 
 print("\nTask 6: Maximum altitude spans")
@@ -163,58 +249,70 @@ altitude_span.show()
 # between consecutive GPS points
 def haversine(lat1, lon1, lat2, lon2):
     """
-    Calculate the great circle distance between two points 
-    on the earth specified in decimal degrees
-    """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    Build a column expression for the great circle distance between two
+    points on the earth specified in decimal degrees
 
+    The formula is composed from native Spark SQL functions, so it is
+    evaluated in the JVM with whole-stage codegen instead of shipping
+    every row to a Python worker
+    """
     # Haversine formula components
-    dlat = lat2 - lat1 
-    dlon = lon2 - lon1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    r = 6371  # Earth's radius in kilometers
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = pow(sin(dlat / 2), 2) + cos(radians(lat1)) * cos(radians(lat2)) * pow(sin(dlon / 2), 2)
+    c = lit(2) * asin(sqrt(a))
+    r = lit(6371)  # Earth's radius in kilometers
     return c * r
 
-# Register haversine function as UDF for use in Spark SQL
-spark.udf.register("haversine", haversine, DoubleType())
-
-# Calculate distances between consecutive points
+# Calculate daily distances in a single pass over each user's day
 # Process:
-# 1. Create window for accessing previous points
-# 2. Calculate distance between consecutive points using Haversine formula
-# 3. Group by user and date to get daily distances
+# 1. Collect each user's points for the day, sorted by adjusted time
+# 2. Walk the sorted points once, carrying the previous point and summing
+#    the Haversine distance between consecutive points
+# 3. Cache the per-day distances, which feed both the per-user maximum and
+#    the overall total
 # 4. Find day with maximum distance for each user
 print("\nTask 7: Distance calculations")
-w = Window.partitionBy("UserID", "adjusted_date").orderBy("adjusted_timestamp")
 distance_df = df \
-    .withColumn("prev_lat", lag("Latitude").over(w)) \
-    .withColumn("prev_lon", lag("Longitude").over(w)) \
-    .filter(col("prev_lat").isNotNull()) \
-    .withColumn("point_distance", 
-        expr("haversine(prev_lat, prev_lon, Latitude, Longitude)")
-    )
+    .groupBy("UserID", "adj_day") \
+    .agg(sort_array(collect_list(struct("adj_epoch_s", "Latitude", "Longitude"))).alias("points")) \
+    .filter(size(col("points")) > 1) \
+    .select(
+        "UserID", "adj_day",
+        aggregate(
+            "points",
+            struct(lit(0.0).alias("distance"), col("points")[0].alias("prev")),
+            lambda acc, p: struct(
+                (acc["distance"] + haversine(
+                    acc["prev"]["Latitude"], acc["prev"]["Longitude"],
+                    p["Latitude"], p["Longitude"]
+                )).alias("distance"),
+                p.alias("prev")
+            ),
+            lambda acc: acc["distance"]
+        ).alias("daily_distance")
+    ) \
+    .persist(StorageLevel.MEMORY_AND_DISK)
 
-# Calculate daily distances and find maximum distance day for each user
+# Find maximum distance day for each user (with earliest date for ties)
+# using the same max-of-struct reduction as Task 5
 daily_distances = distance_df \
-    .groupBy("UserID", "adjusted_date") \
-    .agg(sum("point_distance").alias("daily_distance")) \
-    .withColumn("rank", 
-        row_number().over(
-            Window.partitionBy("UserID")
-            .orderBy(col("daily_distance").desc(), col("adjusted_date").asc())
-        )
-    ) \
-    .filter(col("rank") == 1) \
+    .groupBy("UserID") \
+    .agg(max(struct("daily_distance", (-col("adj_day")).alias("neg_day"))).alias("top")) \
+    .select("UserID", (-col("top.neg_day")).alias("adj_day"), col("top.daily_distance").alias("daily_distance")) \
+    .select("UserID", adjusted_date, "daily_distance") \
     .orderBy(col("daily_distance").desc())
 
 # Calculate total distance across all users
-total_distance = distance_df.agg(sum("point_distance")).collect()[0][0]
+total_distance = distance_df.agg(sum("daily_distance")).collect()[0][0]
 
 print(f"\nTotal distance traveled by all users: {total_distance:.2f} km")
 print("\nLongest daily distances per user:")
 daily_distances.show()
 
-# Clean up Spark session
-spark.stop()
\ No newline at end of file
+# Clean up cached data and Spark session
+distance_df.unpersist()
+daily.unpersist()
+beijing_users.unpersist()
+df.unpersist()
+spark.stop()